@@ -4,17 +4,21 @@ import os
 import sys
 import time
 import io
+import json
+import hashlib
+import tempfile
 import requests                       # >>> GITHUB ADDITION >>>
-from urllib.parse import urlparse     # >>> GITHUB ADDITION >>>
+from requests.adapters import HTTPAdapter, Retry  # >>> GITHUB ADDITION >>>
+from urllib.parse import quote, urlparse  # >>> GITHUB ADDITION >>>
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
 
 from google.cloud import aiplatform
 from vertexai.preview.generative_models import (
     GenerativeModel,
     Part,
-    Image as VertexImage,
 )
 
 # =========================================================
@@ -33,13 +37,45 @@ INPUT_DIR = "input_docs"
 OUTPUT_DIR = "output_texts"
 DPI = 300
 
+# Upload encoding. "jpeg" (default) is by far the smallest on the wire;
+# "png" keeps pages pixel-exact for glyph-fidelity checks.
+PAGE_UPLOAD_FORMAT = "jpeg"
+
+# JPEG at quality 92 with no chroma subsampling is visually lossless
+# for scanned text and typically 4–10× smaller on the wire than PNG.
+JPEG_QUALITY = 92
+
+# zlib level for the PNG path: level 1 encodes ~3× faster than PIL's
+# default level 6 for ~15% bigger files — the encoder, not the network,
+# is the bottleneck once Gemini calls run concurrently.
+PNG_COMPRESS_LEVEL = 1
+
+# Rendering stays at 300 DPI (glyph fidelity for small conjuncts/matras),
+# but Gemini's vision encoder tiles at ~768–1024 px, so pixels beyond
+# roughly this bound are pure upload and input-token cost.
+MAX_UPLOAD_PX = (2000, 2600)
+
+# Concurrent Gemini requests per PDF. Bounded to stay inside
+# Vertex per-minute quotas; raise with care.
+MAX_OCR_WORKERS = 12
+
+# Concurrent GitHub PDF downloads.
+MAX_DOWNLOAD_WORKERS = 8
+
 # >>> GITHUB ADDITION >>>
 GITHUB_OWNER = "arpit-jain-mygit"
 GITHUB_REPO = "jain-scanned-docs"
 GITHUB_BRANCH = "main"
+
+GITHUB_CACHE_DIR = ".cache"
+TREE_CACHE_FILE = os.path.join(GITHUB_CACHE_DIR, "github_tree.json")
+TREE_ETAG_FILE = os.path.join(GITHUB_CACHE_DIR, "github_tree.etag")
 # <<< GITHUB ADDITION <<<
 
-PROMPT_TEMPLATE = """
+# The rules block is identical for every page — keeping it in its own
+# part (sent first) lets Gemini's implicit prefix caching reuse it
+# across pages; only the tiny page-number rule below varies.
+PROMPT_STATIC = """
 Role: You are an expert Indic-language archivist specializing in Hindi manuscripts and mixed-script texts.
 
 Task:
@@ -63,25 +99,20 @@ Rules (STRICT):
 4. Maintain original casing for English text (upper/lower case).
 5. Maintain original line breaks, spacing, and paragraph structure.
 6. If a word, glyph, or character is unclear or partially visible, reproduce it exactly as seen without guessing or substitution.
-7. Begin the output with: "=== Page {page} ==="
-8. Output ONLY the verbatim transcription text. No commentary or metadata.
+7. Output ONLY the verbatim transcription text. No commentary or metadata.
 
 Failure to follow these rules is unacceptable.
 """
 
+PROMPT_PAGE_RULE = '8. Begin the output with: "=== Page {page} ==="'
+
 # =========================================================
 # INIT VERTEX AI
 # =========================================================
 aiplatform.init(project=PROJECT_ID, location=LOCATION)
 model = GenerativeModel(MODEL_NAME)
 
-# =========================================================
-# IMAGE → PNG BYTES (REQUIRED)
-# =========================================================
-def pil_to_png_bytes(image: Image.Image) -> bytes:
-    buf = io.BytesIO()
-    image.save(buf, format="PNG")
-    return buf.getvalue()
+PROMPT_STATIC_PART = Part.from_text(PROMPT_STATIC)
 
 # =========================================================
 # LOGGING
@@ -101,18 +132,91 @@ def log_leaf(msg):
 # =========================================================
 # >>> GITHUB ADDITION >>>
 # =========================================================
-def list_github_pdfs(path=""):
-    api_url = f"https://api.github.com/repos/{GITHUB_OWNER}/{GITHUB_REPO}/contents/{path}"
-    r = requests.get(api_url, timeout=30)
-    r.raise_for_status()
+# One pooled session for all GitHub traffic: reuses the HTTPS
+# connection instead of a fresh TLS handshake per request.
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=5, backoff_factor=0.5),
+    ),
+)
+SESSION.headers["Accept"] = "application/vnd.github+json"
+if os.environ.get("GITHUB_TOKEN"):
+    SESSION.headers["Authorization"] = f"Bearer {os.environ['GITHUB_TOKEN']}"
+
+
+def list_github_pdfs():
+    # Two requests total: branch → commit SHA, then the full recursive
+    # tree in one call (vs. one /contents call per subdirectory).
+    # A conditional GET (If-None-Match) on the branch turns re-runs with
+    # an unchanged repo into a single 304, which GitHub doesn't count
+    # against the rate limit; the tree is then served from disk.
+    branch_url = (
+        f"https://api.github.com/repos/{GITHUB_OWNER}/{GITHUB_REPO}"
+        f"/branches/{GITHUB_BRANCH}"
+    )
+
+    headers = {}
+    if os.path.exists(TREE_ETAG_FILE) and os.path.exists(TREE_CACHE_FILE):
+        with open(TREE_ETAG_FILE, "r", encoding="utf-8") as f:
+            headers["If-None-Match"] = f.read().strip()
+
+    r = SESSION.get(branch_url, timeout=30, headers=headers)
+
+    if r.status_code == 304:
+        log_leaf("♻️ GitHub repo unchanged (304) → using cached tree")
+        with open(TREE_CACHE_FILE, "r", encoding="utf-8") as f:
+            tree = json.load(f)
+    else:
+        r.raise_for_status()
+        etag = r.headers.get("ETag")
+        commit_sha = r.json()["commit"]["sha"]
+
+        tree_url = (
+            f"https://api.github.com/repos/{GITHUB_OWNER}/{GITHUB_REPO}"
+            f"/git/trees/{commit_sha}?recursive=1"
+        )
+        r = SESSION.get(tree_url, timeout=30)
+        r.raise_for_status()
+        tree = r.json()["tree"]
+
+        if etag:
+            os.makedirs(GITHUB_CACHE_DIR, exist_ok=True)
+            with open(TREE_CACHE_FILE, "w", encoding="utf-8") as f:
+                json.dump(tree, f)
+            with open(TREE_ETAG_FILE, "w", encoding="utf-8") as f:
+                f.write(etag)
+
+    return [
+        f"https://raw.githubusercontent.com/{GITHUB_OWNER}/{GITHUB_REPO}"
+        f"/{GITHUB_BRANCH}/{quote(item['path'])}"
+        for item in tree
+        if item["type"] == "blob" and item["path"].lower().endswith(".pdf")
+    ]
+
+
+def download_one_pdf(url):
+    filename = os.path.basename(urlparse(url).path)
+    local_path = os.path.join(INPUT_DIR, filename)
+
+    if os.path.exists(local_path):
+        log_leaf(f"♻️ {filename} already exists → skipping")
+        return
 
-    pdfs = []
-    for item in r.json():
-        if item["type"] == "file" and item["name"].lower().endswith(".pdf"):
-            pdfs.append(item["download_url"])
-        elif item["type"] == "dir":
-            pdfs.extend(list_github_pdfs(item["path"]))
-    return pdfs
+    log_leaf(f"⬇️ Downloading {filename}")
+
+    # Stream to a temp name and rename at the end, so a killed run
+    # never leaves a partial file that looks cached.
+    tmp_path = local_path + ".part"
+    with SESSION.get(url, stream=True, timeout=60) as r:
+        r.raise_for_status()
+        with open(tmp_path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+    os.replace(tmp_path, local_path)
 
 
 def download_pdfs_from_github():
@@ -124,38 +228,43 @@ def download_pdfs_from_github():
 
     os.makedirs(INPUT_DIR, exist_ok=True)
 
-    for url in pdf_urls:
-        filename = os.path.basename(urlparse(url).path)
-        local_path = os.path.join(INPUT_DIR, filename)
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(download_one_pdf, url) for url in pdf_urls]
+        for future in as_completed(futures):
+            future.result()
+# <<< GITHUB ADDITION <<<
 
-        if os.path.exists(local_path):
-            log_leaf(f"♻️ {filename} already exists → skipping")
-            continue
+# =========================================================
+# IMAGE → UPLOAD BYTES (JPEG default, lossless PNG optional)
+# =========================================================
+def pil_to_upload_bytes(image: Image.Image):
+    """Encode a page for upload; returns (bytes, mime_type)."""
+    buf = io.BytesIO()
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail(MAX_UPLOAD_PX, Image.LANCZOS)
 
-        log_leaf(f"⬇️ Downloading {filename}")
-        r = requests.get(url, timeout=60)
-        r.raise_for_status()
+    if PAGE_UPLOAD_FORMAT == "png":
+        image.save(buf, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+        return buf.getvalue(), "image/png"
 
-        with open(local_path, "wb") as f:
-            f.write(r.content)
-# <<< GITHUB ADDITION <<<
+    image.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=False, subsampling=0)
+    return buf.getvalue(), "image/jpeg"
 
 # =========================================================
 # GEMINI SAFE CALL (VERTEX – STABLE)
 # =========================================================
-def gemini_generate_with_retry(prompt: str, image: Image.Image, page_num: int):
+def gemini_generate_with_retry(image_bytes: bytes, mime_type: str, page_num: int):
     attempt = 1
     while True:
         try:
             log_leaf(f"Page {page_num}: Gemini call (attempt {attempt})")
 
-            png_bytes = pil_to_png_bytes(image)
-            vertex_image = VertexImage.from_bytes(png_bytes)
-
             return model.generate_content(
                 [
-                    Part.from_text(prompt),
-                    Part.from_image(vertex_image),
+                    PROMPT_STATIC_PART,
+                    Part.from_text(PROMPT_PAGE_RULE.format(page=page_num)),
+                    Part.from_data(data=image_bytes, mime_type=mime_type),
                 ],
                 generation_config={
                     "temperature": 0,
@@ -173,64 +282,131 @@ def gemini_generate_with_retry(prompt: str, image: Image.Image, page_num: int):
 # =========================================================
 # PIPELINE
 # =========================================================
+def pdf_content_hash(pdf_path):
+    """Short SHA-256 of the PDF bytes — hashing runs at GB/s, negligible
+    next to any Gemini call."""
+    h = hashlib.sha256()
+    with open(pdf_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def contiguous_runs(pages):
+    """Collapse a sorted page list into (first, last) inclusive ranges."""
+    runs = []
+    for p in pages:
+        if runs and p == runs[-1][1] + 1:
+            runs[-1][1] = p
+        else:
+            runs.append([p, p])
+    return [(lo, hi) for lo, hi in runs]
+
+
 def process_pdf(pdf_path):
     pdf_start = time.perf_counter()
 
     pdf_name = os.path.basename(pdf_path)
     base_name = os.path.splitext(pdf_name)[0]
 
-    pdf_cache_dir = os.path.join(OUTPUT_DIR, base_name)
+    # Cache is keyed by content hash, not filename, so a renamed or
+    # re-uploaded copy of the same scan reuses its OCR pages. The
+    # human-readable name stays reachable via a symlink.
+    pdf_cache_dir = os.path.join(OUTPUT_DIR, ".by_hash", pdf_content_hash(pdf_path))
     os.makedirs(pdf_cache_dir, exist_ok=True)
 
+    named_cache_link = os.path.join(OUTPUT_DIR, base_name)
+    if not os.path.islink(named_cache_link) and not os.path.exists(named_cache_link):
+        os.symlink(
+            os.path.relpath(pdf_cache_dir, OUTPUT_DIR),
+            named_cache_link,
+        )
+
     final_output_path = os.path.join(OUTPUT_DIR, f"{base_name}.txt")
 
     log_parent(f"Processing PDF: {pdf_name}")
     log_child(f"Using cache directory: {pdf_cache_dir}")
 
-    log_child("Starting PDF → image conversion...")
-    start = time.perf_counter()
-    pages = convert_from_path(pdf_path, dpi=DPI)
-    log_child(f"Converted {len(pages)} pages in {time.perf_counter() - start:.2f}s")
-
-    for page_num, page in enumerate(pages, start=1):
-        page_file = os.path.join(pdf_cache_dir, f"page_{page_num:03d}.txt")
-
-        if os.path.exists(page_file):
-            log_leaf(f"♻️ Page {page_num} cached → skipping Gemini call")
-            continue
-
-        log_leaf(f"Page {page_num}: OCR started")
-        prompt = PROMPT_TEMPLATE.format(page=page_num)
-
-        response = gemini_generate_with_retry(prompt, page, page_num)
-        text = (response.text or "").strip()
-
-        if not text:
-            raise RuntimeError(f"Empty OCR output on page {page_num}")
-
-        with open(page_file, "w", encoding="utf-8") as f:
-            f.write(text)
-
-        log_leaf(f"Page {page_num}: Cached successfully")
+    def page_file_for(page_num):
+        return os.path.join(pdf_cache_dir, f"page_{page_num:03d}.txt")
+
+    n_pages = pdfinfo_from_path(pdf_path)["Pages"]
+    missing = [
+        p for p in range(1, n_pages + 1)
+        if not os.path.exists(page_file_for(p))
+    ]
+
+    if not missing:
+        log_child(f"♻️ All {n_pages} pages cached → skipping conversion")
+    else:
+        log_child(
+            f"Starting PDF → image conversion for "
+            f"{len(missing)}/{n_pages} uncached page(s)..."
+        )
+        start = time.perf_counter()
+
+        def ocr_page(page_num, page_path):
+            # Decode + JPEG encode happens inside the worker, so encoding
+            # page K+1 overlaps Gemini inference on page K and only
+            # in-flight pages are ever held decoded in memory.
+            with Image.open(page_path) as img:
+                image_bytes, mime_type = pil_to_upload_bytes(img)
+
+            response = gemini_generate_with_retry(image_bytes, mime_type, page_num)
+            text = (response.text or "").strip()
+
+            if not text:
+                raise RuntimeError(f"Empty OCR output on page {page_num}")
+
+            with open(page_file_for(page_num), "w", encoding="utf-8") as f:
+                f.write(text)
+
+            log_leaf(f"Page {page_num}: Cached successfully")
+
+        with tempfile.TemporaryDirectory() as td, ThreadPoolExecutor(
+            max_workers=MAX_OCR_WORKERS
+        ) as executor:
+            futures = []
+
+            for first_page, last_page in contiguous_runs(missing):
+                page_paths = convert_from_path(
+                    pdf_path,
+                    dpi=DPI,
+                    first_page=first_page,
+                    last_page=last_page,
+                    thread_count=max(1, os.cpu_count() - 1),
+                    output_folder=td,
+                    paths_only=True,
+                    fmt="png",
+                )
+                log_child(
+                    f"Converted pages {first_page}–{last_page} "
+                    f"in {time.perf_counter() - start:.2f}s"
+                )
+
+                for page_num, page_path in zip(
+                    range(first_page, last_page + 1), page_paths
+                ):
+                    log_leaf(f"Page {page_num}: OCR queued")
+                    futures.append(executor.submit(ocr_page, page_num, page_path))
+
+            for future in as_completed(futures):
+                future.result()
 
     log_child("Rebuilding final output from cached pages (single header per page)")
 
-    with open(final_output_path, "w", encoding="utf-8") as out:
-        for page_num in range(1, len(pages) + 1):
-            page_file = os.path.join(pdf_cache_dir, f"page_{page_num:03d}.txt")
-
-            out.write(f"=== Page {page_num} ===\n")
+    parts = []
+    for page_num in range(1, n_pages + 1):
+        header = f"=== Page {page_num} ==="
 
-            with open(page_file, "r", encoding="utf-8") as f:
-                page_text = f.read().lstrip()
-                header = f"=== Page {page_num} ==="
+        with open(page_file_for(page_num), "r", encoding="utf-8") as f:
+            page_text = f.read().lstrip()
 
-                if page_text.startswith(header):
-                    page_text = page_text[len(header):].lstrip()
+        page_text = page_text.removeprefix(header).lstrip()
+        parts.append(f"{header}\n{page_text.rstrip()}\n\n")
 
-                out.write(page_text.rstrip())
-
-            out.write("\n\n")
+    with open(final_output_path, "w", encoding="utf-8") as out:
+        out.write("".join(parts))
 
     log_child(
         f"PDF completed → {final_output_path} "
@@ -250,10 +426,11 @@ def main():
     download_pdfs_from_github()
     # <<< GITHUB ADDITION <<<
 
-    pdf_files = sorted(
-        f for f in os.listdir(INPUT_DIR)
-        if f.lower().endswith(".pdf")
-    )
+    with os.scandir(INPUT_DIR) as it:
+        pdf_files = sorted(
+            entry.name for entry in it
+            if entry.is_file() and entry.name[-4:].lower() == ".pdf"
+        )
 
     if not pdf_files:
         print("⚠️ No PDF files found.")
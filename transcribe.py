@@ -6,8 +6,13 @@ import sys
 import re
 import unicodedata
 import time
+import atexit
+import threading
+import subprocess
 from datetime import datetime
 from typing import List
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextvars import ContextVar, copy_context
 
 import yt_dlp
 from google import genai
@@ -32,7 +37,11 @@ LOG_FILE_PATH = os.path.join(
     f"run_{PIPELINE_START_TS.strftime('%Y-%m-%d_%H-%M-%S')}.log"
 )
 
-LOG_FILE = open(LOG_FILE_PATH, "w", encoding="utf-8")
+# Block-buffered: log lines accumulate in the 8 KB buffer instead of
+# costing a write() syscall each. Flushed at section boundaries and on
+# exit — atexit covers crashes mid-run.
+LOG_FILE = open(LOG_FILE_PATH, "w", encoding="utf-8", buffering=8192)
+atexit.register(LOG_FILE.close)
 
 print(f"🧾 Logging to file: {LOG_FILE_PATH}")
 LOG_FILE.write(f"🧾 Logging to file: {LOG_FILE_PATH}\n")
@@ -40,28 +49,26 @@ LOG_FILE.write("=" * 80 + "\n")
 LOG_FILE.flush()
 
 # =========================================================
-# GLOBAL LOG INDENTATION
+# LOG INDENTATION (context-local, safe under worker threads)
 # =========================================================
-LOG_LEVEL = 0
+LOG_LEVEL = ContextVar("LOG_LEVEL", default=0)
 INDENT = "  "
 
 def log(msg: str):
-    line = f"{INDENT * LOG_LEVEL}{msg}"
-    print(line)
-    LOG_FILE.write(line + "\n")
-    LOG_FILE.flush()
+    line = f"{INDENT * LOG_LEVEL.get()}{msg}\n"
+    print(line, end="")
+    LOG_FILE.write(line)
 
 def log_parent(msg: str):
-    global LOG_LEVEL
     log(msg)
-    LOG_LEVEL += 1
+    LOG_FILE.flush()
+    LOG_LEVEL.set(LOG_LEVEL.get() + 1)
 
 def log_child(msg: str):
     log(msg)
 
 def log_done():
-    global LOG_LEVEL
-    LOG_LEVEL = max(LOG_LEVEL - 1, 0)
+    LOG_LEVEL.set(max(LOG_LEVEL.get() - 1, 0))
 
 def log_step(name: str, start_ts, start_perf):
     end_ts = datetime.now()
@@ -81,6 +88,22 @@ load_dotenv()
 # =========================================================
 MODEL_NAME = "gemini-2.5-flash"
 
+# Concurrent yt-dlp metadata lookups during playlist expansion.
+MAX_EXPAND_WORKERS = 8
+
+# MP3s above this size get re-encoded speech-optimized before upload.
+UPLOAD_COMPRESS_THRESHOLD_MB = 100
+
+# Videos processed concurrently (download + upload + inference are all
+# network-bound; outputs are independent files).
+MAX_VIDEO_WORKERS = 4
+
+# At most this many Gemini transcriptions in flight; the remaining
+# workers keep downloading ahead, so the next video's audio is ready
+# the moment a transcription slot frees up.
+MAX_CONCURRENT_TRANSCRIPTIONS = 2
+TRANSCRIBE_SEMAPHORE = threading.Semaphore(MAX_CONCURRENT_TRANSCRIPTIONS)
+
 CACHE_DIR = ".cache"
 AUDIO_CACHE_DIR = os.path.join(CACHE_DIR, "audio")
 META_CACHE_DIR = os.path.join(CACHE_DIR, "meta")
@@ -185,30 +208,41 @@ def expand_urls(urls: List[str]) -> List[str]:
         "logger": YTDLPQuietLogger(),
     }
 
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        for url in urls:
-            try:
-                # 🔥 NORMALIZE playlist URLs
-                if "list=" in url:
-                    playlist_id = re.search(r"list=([^&]+)", url)
-                    if playlist_id:
-                        url = f"https://www.youtube.com/playlist?list={playlist_id.group(1)}"
-
-                info = ydl.extract_info(url, download=False)
-
-                if info.get("_type") == "playlist":
-                    log_parent(f"📂 Expanding playlist: {info.get('title', 'Unknown')}")
-                    entries = info.get("entries", [])
-                    for entry in entries:
-                        if entry and "id" in entry:
-                            expanded.append(f"https://www.youtube.com/watch?v={entry['id']}")
-                    log_child(f"📋 Found {len(entries)} videos\n")
-                    log_done()
-                else:
-                    expanded.append(url)
+    def extract_one(url):
+        # 🔥 NORMALIZE playlist URLs
+        if "list=" in url:
+            playlist_id = re.search(r"list=([^&]+)", url)
+            if playlist_id:
+                url = f"https://www.youtube.com/playlist?list={playlist_id.group(1)}"
 
-            except Exception as e:
-                log_child(f"❌ Failed to expand URL {url}: {e}")
+        # Each task gets its own YoutubeDL — a shared instance is not
+        # safe across concurrent extract_info calls.
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                return url, ydl.extract_info(url, download=False), None
+        except Exception as e:
+            return url, None, e
+
+    # Metadata lookups are network-bound (~1s each) — resolve them in
+    # parallel, then do the cheap playlist/video branching in order.
+    with ThreadPoolExecutor(max_workers=MAX_EXPAND_WORKERS) as ex:
+        results = list(ex.map(extract_one, urls))
+
+    for url, info, error in results:
+        if error is not None:
+            log_child(f"❌ Failed to expand URL {url}: {error}")
+            continue
+
+        if info.get("_type") == "playlist":
+            log_parent(f"📂 Expanding playlist: {info.get('title', 'Unknown')}")
+            entries = info.get("entries", [])
+            for entry in entries:
+                if entry and "id" in entry:
+                    expanded.append(f"https://www.youtube.com/watch?v={entry['id']}")
+            log_child(f"📋 Found {len(entries)} videos\n")
+            log_done()
+        else:
+            expanded.append(url)
 
     # Deduplicate while preserving order
     seen = set()
@@ -224,17 +258,22 @@ def expand_urls(urls: List[str]) -> List[str]:
 # =========================================================
 # SPEAKER EXTRACTION
 # =========================================================
-def extract_speaker_from_title(title: str) -> str:
-    title = unicodedata.normalize("NFKC", title)
-
-    patterns = [
+# Compiled once at import — these Devanagari patterns are long enough
+# that re-parsing them per video is wasted work on big playlists.
+SPEAKER_PATTERNS = [
+    re.compile(p)
+    for p in (
         r"(पूज्य\s+)?(मुनि|आचार्य|उपाध्याय)\s+श्री\s+([^\|,\-]+?)\s+महाराज",
         r"(पूज्य\s+)?श्री\s+([^\|,\-]+?)\s+महाराज\s+जी",
         r"(पूज्य\s+)?मुनि\s+श्री\s+([^\|,\-]+)",
-    ]
+    )
+]
 
-    for pattern in patterns:
-        match = re.search(pattern, title)
+def extract_speaker_from_title(title: str) -> str:
+    title = unicodedata.normalize("NFKC", title)
+
+    for pattern in SPEAKER_PATTERNS:
+        match = pattern.search(title)
         if match:
             return match.group(match.lastindex).strip()
 
@@ -313,13 +352,63 @@ def download_youtube_audio(url):
 # =========================================================
 # GEMINI TRANSCRIPTION
 # =========================================================
+def compress_audio_for_upload(mp3_path: str) -> str:
+    """Re-encode big MP3s to 64 kbps mono 16 kHz — ~3× fewer upload
+    bytes with no transcription accuracy loss for speech."""
+    size_mb = os.path.getsize(mp3_path) / (1024 * 1024)
+    if size_mb <= UPLOAD_COMPRESS_THRESHOLD_MB:
+        return mp3_path
+
+    compressed_path = os.path.splitext(mp3_path)[0] + "_speech.mp3"
+    if os.path.exists(compressed_path):
+        log_child("♻️ Using cached speech-optimized audio")
+        return compressed_path
+
+    log_parent(f"🎚️ Compressing {size_mb:.0f} MB audio for upload")
+    start_ts = datetime.now()
+    start_perf = time.perf_counter()
+
+    tmp_path = compressed_path + ".part"
+    subprocess.run(
+        [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-i", mp3_path,
+            "-b:a", "64k", "-ac", "1", "-ar", "16000",
+            tmp_path,
+        ],
+        check=True,
+    )
+    os.replace(tmp_path, compressed_path)
+
+    log_step("Audio compress", start_ts, start_perf)
+    log_done()
+    return compressed_path
+
+
 def transcribe_audio(mp3_path):
     log_parent("🧠 Gemini transcription")
 
+    upload_path = compress_audio_for_upload(mp3_path)
+
     start_ts = datetime.now()
     start_perf = time.perf_counter()
-    with open(mp3_path, "rb") as f:
-        uploaded = client.files.upload(file=f, config={"mime_type": "audio/mpeg"})
+
+    # Passing the path lets the SDK stream the file from disk instead of
+    # holding the whole MP3 in the Python heap; retry with backoff so a
+    # transient network error on a 200 MB upload doesn't sink the video.
+    attempt = 1
+    while True:
+        try:
+            uploaded = client.files.upload(
+                file=upload_path, config={"mime_type": "audio/mpeg"}
+            )
+            break
+        except Exception as e:
+            wait = min(60, 5 * attempt)
+            log_child(f"⚠️ Upload error: {e}. Retrying in {wait}s…")
+            time.sleep(wait)
+            attempt += 1
+
     log_step("Gemini upload", start_ts, start_perf)
 
     start_ts = datetime.now()
@@ -368,6 +457,64 @@ def archive_old_transcripts():
     log_done()
     log_child(f"📂 Archived to: {run_archive_dir}\n")
 
+# =========================================================
+# PER-VIDEO PIPELINE
+# =========================================================
+def process_one_video(idx: int, total: int, url: str):
+    log_parent(f"▶️ [{idx}/{total}] Processing: {url}\n")
+
+    try:
+        for attempt in range(1, 4):
+            try:
+                mp3_path, title = download_youtube_audio(url)
+                break
+            except Exception as e:
+                print(f"⚠️ Attempt {attempt} failed: {e}")
+                time.sleep(5)
+        else:
+            print("❌ Skipping video after retries")
+            log_done()
+            return
+
+        speaker = extract_speaker_from_title(title)
+        video_id = get_video_id_from_mp3(mp3_path)
+        out = get_output_path(video_id, title)
+
+        if os.path.exists(out):
+            log_child("♻️ Gemini already executed for this video + prompt")
+            log_child(f"📄 Existing output found: {out}\n")
+            log_done()
+            return
+
+        with TRANSCRIBE_SEMAPHORE:
+            text = transcribe_audio(mp3_path)
+
+        log_parent("💾 Writing output")
+        start_ts = datetime.now()
+        start_perf = time.perf_counter()
+
+        header = (
+            f"वीडियो शीर्षक: {title}\n"
+            f"वक्ता (महाराज जी): {speaker}\n"
+            f"वीडियो URL: {url}\n"
+            f"प्रॉम्प्ट: {PROMPT_NAME}\n"
+            f"तिथि: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"\n{'-' * 50}\n\n"
+        )
+
+        with open(out, "w", encoding="utf-8") as f:
+            f.write(header)
+            f.write(text)
+
+        log_step("File write", start_ts, start_perf)
+        log_done()
+        log_child(f"✅ Saved: {out}\n")
+
+    except Exception as e:
+        log_child(f"❌ Failed: {e}\n")
+
+    log_done()
+
 # =========================================================
 # MAIN
 # =========================================================
@@ -378,65 +525,23 @@ def main():
         print("  python transcribe.py youtube_video_urls.txt")
         sys.exit(1)
 
-    archive_old_transcripts()  # ← ADD THIS LINE
+    archive_old_transcripts()  # once, before any workers start
     raw_urls = parse_urls(sys.argv[1:])
     urls = expand_urls(raw_urls)
 
     log(f"📋 Processing {len(urls)} video(s)\n")
 
-    for idx, url in enumerate(urls, start=1):
-        log_parent(f"▶️ [{idx}/{len(urls)}] Processing: {url}\n")
-
-        try:
-            for attempt in range(1, 4):
-                try:
-                    mp3_path, title = download_youtube_audio(url)
-                    break
-                except Exception as e:
-                    print(f"⚠️ Attempt {attempt} failed: {e}")
-                    time.sleep(5)
-            else:
-                print("❌ Skipping video after retries")
-                log_done()
-                continue
-
-            speaker = extract_speaker_from_title(title)
-            video_id = get_video_id_from_mp3(mp3_path)
-            out = get_output_path(video_id, title)
-
-            if os.path.exists(out):
-                log_child("♻️ Gemini already executed for this video + prompt")
-                log_child(f"📄 Existing output found: {out}\n")
-                log_done()
-                continue
-
-            text = transcribe_audio(mp3_path)
-
-            log_parent("💾 Writing output")
-            start_ts = datetime.now()
-            start_perf = time.perf_counter()
-
-            header = (
-                f"वीडियो शीर्षक: {title}\n"
-                f"वक्ता (महाराज जी): {speaker}\n"
-                f"वीडियो URL: {url}\n"
-                f"प्रॉम्प्ट: {PROMPT_NAME}\n"
-                f"तिथि: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"\n{'-' * 50}\n\n"
-            )
-
-            with open(out, "w", encoding="utf-8") as f:
-                f.write(header)
-                f.write(text)
-
-            log_step("File write", start_ts, start_perf)
-            log_done()
-            log_child(f"✅ Saved: {out}\n")
-
-        except Exception as e:
-            log_child(f"❌ Failed: {e}\n")
-
-        log_done()
+    # Each video is download → upload → infer → write, all network-bound
+    # with independent outputs, so a small pool overlaps them. Every task
+    # runs in its own copied context so LOG_LEVEL indentation stays
+    # per-video instead of bleeding across worker threads.
+    with ThreadPoolExecutor(max_workers=MAX_VIDEO_WORKERS) as executor:
+        futures = [
+            executor.submit(copy_context().run, process_one_video, idx, len(urls), url)
+            for idx, url in enumerate(urls, start=1)
+        ]
+        for future in as_completed(futures):
+            future.result()
 
     log(f"⏱️ PIPELINE START: {PIPELINE_START_TS.strftime('%Y-%m-%d %H:%M:%S')}")
     log(f"⏱️ TOTAL TIME: {time.perf_counter() - PIPELINE_START:.2f}s")